@@ -1,16 +1,24 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import yfinance as yf
 import pandas as pd
+import numpy as np
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.api_core import retry as google_retry
 import os
+import string
+from pathlib import Path
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- Setup ---
 st.set_page_config(
     page_title="SGX Stock Insights",
     page_icon="📈",
     layout="wide",
-    initial_sidebar_state="expanded"
+    initial_sidebar_state="collapsed"
 )
 
 # Set up Gemini API key from Streamlit secrets
@@ -57,208 +65,391 @@ STI_COMPANIES = {
     'S68.SI': 'Singapore Exchange',
     'U14.SI': 'UOL Group',
     'Q01.SI': 'ComfortDelGro Corporation',
-    'N52.SI': 'NetLink NBN Trust',
-    'T39.SI': 'Thai Beverage Public Co Ltd'
+    'N52.SI': 'NetLink NBN Trust'
 }
 
+# Parallel arrays of tickers and names for vectorized filtering
+TICKERS = np.array(list(STI_COMPANIES.keys()))
+NAMES = np.array(list(STI_COMPANIES.values()))
+
+
+# --- Stock Data Cache Settings ---
+# Downloaded prices are kept in memory and on disk until the end of the current
+# STOCK_DATA_TTL-second window, so that restarts within that window reuse them.
+STOCK_DATA_TTL = 3600  # seconds
+STOCK_DATA_CACHE = Path(__file__).parent / ".cache" / "stock_data.pkl"
+
+
+# --- Gemini Request Settings ---
+# Client-side rate limits, kept about 20% below the account tier's
+# requests-per-minute and tokens-per-minute quotas. The defaults target the
+# free tier (10 RPM, 250k TPM), which spaces uncached insights about 7.5 s apart.
+# On a paid tier, raise them in Streamlit secrets, e.g. GEMINI_RPM = 400,
+# GEMINI_TPM = 180000 and GEMINI_BURST = 8 to let the worker pool run in parallel.
+GEMINI_RPM = int(st.secrets.get("GEMINI_RPM", 8))
+GEMINI_TPM = int(st.secrets.get("GEMINI_TPM", 200_000))
+GEMINI_BURST = int(st.secrets.get("GEMINI_BURST", 1))
+
+# Rate limits and server errors are retried with exponential backoff and jitter.
+# If they persist, the circuit breaker pauses Gemini calls for a cooldown period.
+TRANSIENT_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+GEMINI_RETRY = google_retry.Retry(
+    predicate=google_retry.if_exception_type(*TRANSIENT_GEMINI_ERRORS),
+    initial=1.0,
+    maximum=10.0,
+    multiplier=2.0,
+    timeout=30.0,
+)
+CIRCUIT_BREAKER_COOLDOWN = 60  # seconds
+
+
+# --- Card Templates ---
+# Each section's cards are joined into one CSS grid and rendered with a single st.markdown call.
+# HTML lines are kept unindented so Markdown does not treat them as code blocks.
+HIGHLIGHT_CARD_TEMPLATE = string.Template("""<div class="stCard highlight-card">
+<div class="card-title">$name</div>
+<div class="card-ticker">$ticker</div>
+<div class="price">S$$$price</div>
+<div class="change-negative">
+<span style='font-size:1.2rem;'>▼</span>
+<span style='font-weight:bold;'>$change%</span>
+</div>
+<div class="insight-text">
+<strong>Insight:</strong> $insight
+</div>
+</div>""")
+
+CARD_TEMPLATE = string.Template("""<div class="stCard">
+<div class="card-title">$name</div>
+<div class="card-ticker">$ticker</div>
+<div class="price">S$$$price</div>
+<div class="$change_class">
+<span style='font-size:1.2rem;'>$change_arrow</span>
+<span style='font-weight:bold;'>$change%</span>
+</div>
+</div>""")
+
+
 
 # --- Functions ---
-@st.cache_data(ttl=3600)  # Cache data for 1 hour
-def fetch_stock_data(ticker_list):
+def download_stock_data(ticker_list):
     """
-    Fetches historical stock data from Yahoo Finance.
+    Downloads historical stock data from Yahoo Finance in a single batch request.
+    Tickers missing from the batch result are retried individually in parallel.
     Returns a dictionary of DataFrames.
     """
     data = {}
+    try:
+        raw = yf.download(
+            list(ticker_list),
+            period="3mo",
+            group_by="ticker",
+            threads=True,
+            auto_adjust=False,
+            progress=False,
+        )
+        batch_tickers = set(raw.columns.get_level_values(0))
+    except Exception as e:
+        st.warning(f"Could not fetch stock data in one batch, retrying per ticker: {e}")
+        raw, batch_tickers = None, set()
+
+    missing = []
     for ticker in ticker_list:
-        try:
-            df = yf.download(ticker, period="3mo")
-            if not df.empty:
-                data[ticker] = df
-        except Exception as e:
-            st.warning(f"Could not fetch data for {ticker}: {e}")
+        if ticker not in batch_tickers:
+            missing.append(ticker)
             continue
+        df = raw[ticker].dropna(how="all")
+        if not df.empty:
+            data[ticker] = df
+        else:
+            missing.append(ticker)
+
+    if missing:
+        # yf.download shares module-level state between calls, so the parallel
+        # fallback uses Ticker objects, which keep their own state
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            futures = {
+                executor.submit(yf.Ticker(ticker).history, period="3mo", auto_adjust=False): ticker
+                for ticker in missing
+            }
+            for future in as_completed(futures):
+                ticker = futures[future]
+                try:
+                    df = future.result()
+                    if not df.empty:
+                        # Match the timezone-naive dates returned by the batch download
+                        if df.index.tz is not None:
+                            df = df.tz_localize(None)
+                        data[ticker] = df
+                    else:
+                        st.warning(f"Could not fetch data for {ticker}")
+                except Exception as e:
+                    st.warning(f"Could not fetch data for {ticker}: {e}")
     return data
 
-def get_llm_insight(company_name, ticker, drop_percentage):
+@st.cache_data(ttl=STOCK_DATA_TTL, show_spinner=False)  # Cache data for 1 hour
+def fetch_stock_data(ticker_list, cache_window):
+    """
+    Returns historical stock data, reusing the on-disk copy saved during the same
+    cache_window so app restarts skip Yahoo Finance. Callers pass
+    int(time.time() // STOCK_DATA_TTL), so the memory and disk copies both
+    expire at the end of the window.
+    Returns a dictionary of DataFrames.
+    """
+    try:
+        cached = pd.read_pickle(STOCK_DATA_CACHE)
+        if cached['window'] == cache_window and cached['tickers'] == tuple(ticker_list):
+            return cached['data']
+    except Exception:
+        pass  # Missing, stale or unreadable cache file, download fresh data
+
+    data = download_stock_data(ticker_list)
+    if data:
+        try:
+            STOCK_DATA_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so readers never see a partial pickle
+            temp_path = STOCK_DATA_CACHE.with_suffix('.tmp')
+            pd.to_pickle({'window': cache_window, 'tickers': tuple(ticker_list), 'data': data}, temp_path)
+            os.replace(temp_path, STOCK_DATA_CACHE)
+        except OSError:
+            pass  # Disk cache is best-effort
+    return data
+
+@st.cache_resource
+def get_gemini_model(model_name='gemini-2.5-flash-preview-05-20'):
+    """
+    Creates the Gemini model client once and shares it across reruns and sessions.
+    The returned object must not be mutated.
+    """
+    return genai.GenerativeModel(model_name)
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling Gemini while the circuit breaker is open.
+    """
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting requests per minute and tokens per minute.
+    The bucket starts with and holds at most `burst` requests (and the matching
+    share of tokens), so no 60 s window exceeds rpm + burst requests.
+    acquire() blocks until both budgets can cover the request.
     """
-    Generates a brief LLM-based insight for a stock.
-    The prompt is designed to produce a short, concise analysis.
+    def __init__(self, rpm, tpm, burst=1):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_requests = float(burst)
+        self.max_tokens = tpm * burst / rpm
+        self.available_requests = self.max_requests
+        self.available_tokens = self.max_tokens
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        tokens = min(tokens, self.max_tokens)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.last_refill
+                self.last_refill = now
+                self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.rpm / 60)
+                self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.tpm / 60)
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.rpm,
+                    (tokens - self.available_tokens) * 60 / self.tpm
+                )
+            time.sleep(wait)
+
+@st.cache_resource
+def get_rate_limiter():
+    """
+    Shared Gemini rate limiter across reruns, sessions and worker threads.
+    """
+    return TokenBucket(rpm=GEMINI_RPM, tpm=GEMINI_TPM, burst=GEMINI_BURST)
+
+@st.cache_resource
+def get_circuit_breaker():
     """
-    prompt = f"""
-    You are a professional financial analyst. Provide a very brief, high-level insight
-    (2-3 sentences max) for the stock of {company_name} ({ticker}).
-    It has dropped by {abs(drop_percentage):.2f}% over the past two weeks.
-    Focus on potential reasons for the drop and its status as a potential investment
-    highlighting that it is a blue-chip company. Do not use complex financial jargon.
-    Do not mention specific prices or dates.
+    Shared Gemini circuit breaker state across reruns and sessions.
+    While open_until is in the future, uncached insight requests are skipped.
+    """
+    return {"open_until": 0.0}
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)  # Cache insights for 1 hour
+def generate_llm_insight(company_name, ticker, drop_percentage):
+    """
+    Generates a brief LLM-based insight for a stock, retrying transient errors.
+    Raises on failure so that errors are never cached.
+    """
+    # Only cache misses reach this point, so cached insights are still served
+    # while the circuit breaker is open
+    if time.monotonic() < get_circuit_breaker()["open_until"]:
+        raise CircuitOpenError("Gemini circuit breaker is open")
+
+    prompt = (
+        f"2-sentence blue-chip drop rationale for {company_name} ({ticker}), "
+        f"down {abs(drop_percentage):.1f}% in 2 weeks. Note investment potential. No jargon, no prices/dates."
+    )
+
+    rate_limiter = get_rate_limiter()
+    prompt_tokens = len(prompt) // 4  # Roughly 4 characters per token
+    attempts = 0
+
+    def request():
+        # Retries wait for the rate limiter too. The first token is taken before
+        # the retry clock starts, so queueing behind other workers does not use
+        # up the retry timeout.
+        nonlocal attempts
+        if attempts:
+            rate_limiter.acquire(tokens=prompt_tokens)
+        attempts += 1
+        return get_gemini_model().generate_content(prompt, request_options={"retry": None})
+
+    rate_limiter.acquire(tokens=prompt_tokens)
+    response = GEMINI_RETRY(request)()
+    return response.text
+
+def get_llm_insight(company_name, ticker, drop_percentage):
+    """
+    Returns a brief LLM-based insight for a stock, or a message if it is unavailable.
+    Callers should round drop_percentage so small price moves reuse the cached insight.
     """
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
-        response = model.generate_content(prompt)
-        insight = response.text
-        return insight
+        return generate_llm_insight(company_name, ticker, drop_percentage)
+    except CircuitOpenError:
+        return "Analysis temporarily unavailable. Please try again shortly."
+    except TRANSIENT_GEMINI_ERRORS + (google_exceptions.RetryError,):
+        # Retries are exhausted, so stop calling Gemini for a while
+        get_circuit_breaker()["open_until"] = time.monotonic() + CIRCUIT_BREAKER_COOLDOWN
+        return "Analysis temporarily unavailable. Please try again shortly."
     except Exception as e:
         return f"Could not generate LLM insight: {e}"
 
+@st.cache_resource
+def load_css():
+    """
+    Reads the app stylesheet from disk once per server process.
+    """
+    return (Path(__file__).parent / "style.css").read_text()
+
+def compute_drops(closes):
+    """
+    Computes the two-week price change for every ticker at once.
+    Takes a DataFrame of closing prices with one column per entry in TICKERS and
+    returns NumPy arrays aligned with TICKERS: current prices, drop percentages
+    and a mask of tickers with at least two closes in the window.
+    """
+    if closes.empty:
+        return np.full(len(TICKERS), np.nan), np.zeros(len(TICKERS)), np.zeros(len(TICKERS), dtype=bool)
+
+    # Compare the latest close with the close two weeks (14 trading rows) earlier
+    last_two_weeks_data = closes.iloc[-14:]
+    has_enough_data = last_two_weeks_data.count().to_numpy() >= 2
+    window = last_two_weeks_data.ffill().bfill().to_numpy()
+    current_prices = window[-1]
+    prices_two_weeks_ago = window[0]
+    drop_percentages = np.divide(
+        current_prices - prices_two_weeks_ago,
+        prices_two_weeks_ago,
+        out=np.zeros_like(current_prices),
+        where=prices_two_weeks_ago > 0
+    ) * 100
+    return current_prices, drop_percentages, has_enough_data
+
+@st.fragment
+def render_cards(current_prices, drop_percentages, has_enough_data):
+    """
+    Renders the threshold slider and the stock cards.
+    Runs as a fragment so moving the slider only reruns this section.
+    """
+    significant_drop_pct = st.slider("Significant Drop Threshold (%)", 0.0, 15.0, 5.0)
+
+    # Classify every ticker against the threshold in one vectorized comparison
+    is_significant_drop = drop_percentages < -significant_drop_pct
+    highlight_mask = has_enough_data & is_significant_drop
+    other_mask = has_enough_data & ~is_significant_drop
+
+    highlighted_stocks = [
+        {'ticker': ticker, 'name': name, 'current_price': current_price, 'drop_percentage': drop_percentage}
+        for ticker, name, current_price, drop_percentage in zip(
+            TICKERS[highlight_mask], NAMES[highlight_mask],
+            current_prices[highlight_mask], drop_percentages[highlight_mask]
+        )
+    ]
+    with st.spinner("Generating insights..."):
+        # Request all LLM insights concurrently instead of one after another.
+        # Workers get this run's script context so cached functions work in them.
+        script_run_ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(
+            max_workers=8,
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), script_run_ctx)
+        ) as executor:
+            insights = executor.map(
+                lambda stock: get_llm_insight(stock['name'], stock['ticker'], round(stock['drop_percentage'], 1)),
+                highlighted_stocks
+            )
+            for stock, insight in zip(highlighted_stocks, insights):
+                stock['insight'] = insight
+
+    if highlighted_stocks:
+        st.markdown('<div class="section-title">📉 Potential Opportunities: Significant Drops</div>', unsafe_allow_html=True)
+        st.markdown('<p style="color:#b3b3b3;">These blue-chip stocks have dropped by more than the selected threshold over the last two weeks, potentially offering a buying opportunity.</p>', unsafe_allow_html=True)
+        # Render the whole grid with one st.markdown call
+        cards_html = "".join(
+            HIGHLIGHT_CARD_TEMPLATE.substitute(
+                name=stock['name'],
+                ticker=stock['ticker'],
+                price=f"{stock['current_price']:.2f}",
+                change=f"{stock['drop_percentage']:.2f}",
+                insight=stock['insight']
+            )
+            for stock in highlighted_stocks
+        )
+        st.markdown(f'<div class="card-grid highlight-grid">{cards_html}</div>', unsafe_allow_html=True)
+
+    st.markdown('<div class="section-title">📊 All SGX Blue Chips</div>', unsafe_allow_html=True)
+    st.markdown('<p style="color:#b3b3b3;">Performance of the Straits Times Index (STI) constituents.</p>', unsafe_allow_html=True)
+
+    # Render the whole grid with one st.markdown call
+    cards_html = "".join(
+        CARD_TEMPLATE.substitute(
+            name=name,
+            ticker=ticker,
+            price=f"{current_price:.2f}",
+            change=f"{drop_percentage:.2f}",
+            change_class="change-positive" if drop_percentage >= 0 else "change-negative",
+            change_arrow="▲" if drop_percentage >= 0 else "▼"
+        )
+        for ticker, name, current_price, drop_percentage in zip(
+            TICKERS[other_mask], NAMES[other_mask],
+            current_prices[other_mask], drop_percentages[other_mask]
+        )
+    )
+    if cards_html:
+        st.markdown(f'<div class="card-grid">{cards_html}</div>', unsafe_allow_html=True)
+
 # --- Main App Logic ---
 st.title("🇸🇬 SGX Blue Chip Stock Insights")
-st.markdown("""
-<style>
-    .reportview-container {
-        background: #141414;
-    }
-    .main .block-container {
-        padding-top: 2rem;
-        padding-right: 2rem;
-        padding-left: 2rem;
-        padding-bottom: 2rem;
-    }
-    .stCard {
-        background-color: #2a2a2a;
-        color: white;
-        border-radius: 12px;
-        border: 2px solid #2a2a2a;
-        padding: 20px;
-        transition: transform 0.2s, border-color 0.2s;
-        box-shadow: 0 4px 8px rgba(0,0,0,0.2);
-    }
-    .stCard:hover {
-        transform: scale(1.02);
-        border-color: #e50914;
-    }
-    .card-title {
-        font-size: 1.25rem;
-        font-weight: bold;
-        color: white;
-        margin-bottom: 0.5rem;
-    }
-    .card-ticker {
-        font-size: 0.9rem;
-        color: #b3b3b3;
-        margin-top: 0;
-    }
-    .price {
-        font-size: 1.5rem;
-        font-weight: bold;
-        color: #fff;
-    }
-    .change-positive {
-        color: #4CAF50;
-    }
-    .change-negative {
-        color: #F44336;
-    }
-    .section-title {
-        font-size: 1.8rem;
-        font-weight: bold;
-        color: white;
-        margin-top: 2rem;
-        margin-bottom: 1rem;
-        border-bottom: 2px solid #e50914;
-        padding-bottom: 0.5rem;
-    }
-    .highlight-card {
-        border-color: #e50914;
-        border-width: 4px;
-        box-shadow: 0 4px 20px rgba(229, 9, 20, 0.4);
-    }
-    .insight-text {
-        font-size: 0.95rem;
-        color: #d1d1d1;
-        margin-top: 1rem;
-        line-height: 1.5;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-st.sidebar.header("Filter & Settings")
-significant_drop_pct = st.sidebar.slider("Significant Drop Threshold (%)", 0.0, 15.0, 5.0)
-
-with st.spinner("Fetching stock data and generating insights..."):
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
+
+with st.spinner("Fetching stock data..."):
     # Fetch all data at once to reduce API calls
-    all_stocks_data = fetch_stock_data(list(STI_COMPANIES.keys()))
-
-    highlighted_stocks = []
-    other_stocks = []
-
-    for ticker, name in STI_COMPANIES.items():
-        if ticker in all_stocks_data:
-            df = all_stocks_data[ticker]
-            if df.empty:
-                continue
-
-            # Check for data over the last 14 days
-            last_two_weeks_data = df.tail(14)
-            if len(last_two_weeks_data) < 2:
-                continue
-
-            current_price = last_two_weeks_data['Close'].iloc[-1]
-            price_two_weeks_ago = last_two_weeks_data['Close'].iloc[0]
-
-            if price_two_weeks_ago > 0:
-                drop_percentage = ((current_price - price_two_weeks_ago) / price_two_weeks_ago) * 100
-            else:
-                drop_percentage = 0
-
-            # Determine if it's a significant drop
-            if drop_percentage < -significant_drop_pct:
-                insight = get_llm_insight(name, ticker, drop_percentage)
-                highlighted_stocks.append({
-                    'ticker': ticker,
-                    'name': name,
-                    'current_price': current_price,
-                    'drop_percentage': drop_percentage,
-                    'insight': insight
-                })
-            else:
-                other_stocks.append({
-                    'ticker': ticker,
-                    'name': name,
-                    'current_price': current_price,
-                    'drop_percentage': drop_percentage
-                })
+    all_stocks_data = fetch_stock_data(tuple(sorted(STI_COMPANIES)), int(time.time() // STOCK_DATA_TTL))
+
+# Align closing prices into one DataFrame with one column per entry in TICKERS
+closes = pd.DataFrame({
+    ticker: df['Close'] for ticker, df in all_stocks_data.items()
+}).reindex(columns=TICKERS)
+current_prices, drop_percentages, has_enough_data = compute_drops(closes)
 
 # --- Display Content ---
-if highlighted_stocks:
-    st.markdown('<div class="section-title">📉 Potential Opportunities: Significant Drops</div>', unsafe_allow_html=True)
-    st.markdown('<p style="color:#b3b3b3;">These blue-chip stocks have dropped by more than the selected threshold over the last two weeks, potentially offering a buying opportunity.</p>', unsafe_allow_html=True)
-    cols = st.columns(3)
-    for i, stock in enumerate(highlighted_stocks):
-        with cols[i % 3]:
-            st.markdown(f"""
-            <div class="stCard highlight-card">
-                <div class="card-title">{stock['name']}</div>
-                <div class="card-ticker">{stock['ticker']}</div>
-                <div class="price">S${stock['current_price']:.2f}</div>
-                <div class="change-negative">
-                    <span style='font-size:1.2rem;'>▼</span>
-                    <span style='font-weight:bold;'>{stock['drop_percentage']:.2f}%</span>
-                </div>
-                <div class="insight-text">
-                    <strong>Insight:</strong> {stock['insight']}
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
-            st.markdown("---")
-
-st.markdown('<div class="section-title">📊 All SGX Blue Chips</div>', unsafe_allow_html=True)
-st.markdown('<p style="color:#b3b3b3;">Performance of the Straits Times Index (STI) constituents.</p>', unsafe_allow_html=True)
-
-cols = st.columns(4)
-for i, stock in enumerate(other_stocks):
-    with cols[i % 4]:
-        change_class = "change-positive" if stock['drop_percentage'] >= 0 else "change-negative"
-        change_arrow = "▲" if stock['drop_percentage'] >= 0 else "▼"
-        st.markdown(f"""
-        <div class="stCard">
-            <div class="card-title">{stock['name']}</div>
-            <div class="card-ticker">{stock['ticker']}</div>
-            <div class="price">S${stock['current_price']:.2f}</div>
-            <div class="{change_class}">
-                <span style='font-size:1.2rem;'>{change_arrow}</span>
-                <span style='font-weight:bold;'>{stock['drop_percentage']:.2f}%</span>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
-        st.markdown("---")
+render_cards(current_prices, drop_percentages, has_enough_data)